@@ -121,14 +121,21 @@ export const epubConvert = async (req: Request, res: Response): Promise<void> =>
         timeout: 300000 // 5分钟超时
       });
 
-      // 返回EPUB微服务的响应
+      // 返回EPUB微服务的响应（部分文件被准入控制拒绝时同样带有 Retry-After）
+      if (response.headers['retry-after']) {
+        res.setHeader('Retry-After', response.headers['retry-after']);
+      }
       res.json(response.data);
 
     } catch (error: any) {
       console.error('EPUB微服务调用失败:', error);
       
       if (error.response) {
-        // EPUB微服务返回了错误响应
+        // EPUB微服务返回了错误响应，429/503 时转发 Retry-After 供客户端退避重试
+        const retryAfter = error.response.headers['retry-after'];
+        if (retryAfter) {
+          res.setHeader('Retry-After', retryAfter);
+        }
         res.status(error.response.status).json(error.response.data);
       } else if (error.code === 'ECONNREFUSED') {
         res.status(503).json({
@@ -167,15 +174,24 @@ export const epubDownload = async (req: Request, res: Response): Promise<void> =
       return;
     }
 
+    // 输出格式（txt/jsonl/md）由微服务校验
+    const { format } = req.query;
+
     // 调用EPUB微服务下载接口
     const response = await axios.get(`${EPUB_SERVICE_URL}/download/${fileId}`, {
+      params: typeof format === 'string' ? { format } : undefined,
       responseType: 'stream',
       timeout: 60000 // 1分钟超时
     });
 
-    // 设置响应头
-    res.setHeader('Content-Type', 'text/plain; charset=utf-8');
-    res.setHeader('Content-Disposition', `attachment; filename="${fileId}.txt"`);
+    // 转发微服务的响应头（文件类型和使用原始文件名的下载名）
+    res.setHeader('Content-Type', response.headers['content-type'] || 'text/plain; charset=utf-8');
+    if (response.headers['content-disposition']) {
+      res.setHeader('Content-Disposition', response.headers['content-disposition']);
+    }
+    if (response.headers['content-length']) {
+      res.setHeader('Content-Length', response.headers['content-length']);
+    }
 
     // 流式传输文件
     response.data.pipe(res);
@@ -184,7 +200,10 @@ export const epubDownload = async (req: Request, res: Response): Promise<void> =
     console.error('EPUB下载失败:', error);
     
     if (error.response) {
-      res.status(error.response.status).json(error.response.data);
+      // 以流方式请求时错误响应体也是流，原样转发
+      res.status(error.response.status);
+      res.setHeader('Content-Type', error.response.headers['content-type'] || 'application/json');
+      error.response.data.pipe(res);
     } else if (error.code === 'ECONNREFUSED') {
       res.status(503).json({
         success: false,
@@ -1,9 +1,13 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file
 from flask_cors import CORS
 import os
 import sys
 import uuid
+import hmac
+import hashlib
+import zipfile
 import logging
+import tempfile
 from werkzeug.utils import secure_filename
 
 # 添加当前目录到Python路径
@@ -11,12 +15,27 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from services.epub_converter import EpubConverter
 from services.text_processor import TextProcessor
+from services.admission_controller import AdmissionController, AdmissionRejected
+from services.output_writers import EXTRA_WRITERS, OUTPUT_MIMETYPES, output_path, remove_stale_parts
+from services.bulk_converter import BulkConverter
+from services.profiler import ConversionProfiler, PROFILE_ARTIFACTS
+from services.file_index import FileIndex, public_record
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ServiceRequest(Request):
+    """批量转换接口上传的压缩包单独使用更大的大小上限"""
+    
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'bulk_convert':
+            return app.config['BULK_MAX_ARCHIVE_SIZE']
+        return super().max_content_length
+
 app = Flask(__name__)
+app.request_class = ServiceRequest
 CORS(app)  # 允许跨域请求
 
 # 配置
@@ -24,9 +43,65 @@ app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024  # 增加到100MB
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['CONVERTED_FOLDER'] = 'converted'
 
+# 准入控制配置：内存预算、CPU预算（同时处理的章节总数）、最大并发、排队长度和排队超时
+app.config['CONVERT_MEMORY_BUDGET'] = int(os.environ.get('CONVERT_MEMORY_BUDGET_MB', '512')) * 1024 * 1024
+app.config['CONVERT_CPU_BUDGET'] = int(os.environ.get('CONVERT_CPU_BUDGET', '1000'))
+app.config['CONVERT_MAX_CONCURRENT'] = int(os.environ.get('CONVERT_MAX_CONCURRENT', str(os.cpu_count() or 2)))
+app.config['CONVERT_MAX_QUEUE'] = int(os.environ.get('CONVERT_MAX_QUEUE', '16'))
+app.config['CONVERT_QUEUE_TIMEOUT'] = float(os.environ.get('CONVERT_QUEUE_TIMEOUT', '30'))
+
+# 转换时间预算：整本书超时后保存已完成章节，单章超时后降级为快速模式
+app.config['CONVERT_BOOK_TIMEOUT'] = float(os.environ.get('CONVERT_BOOK_TIMEOUT', '120'))
+app.config['CONVERT_CHAPTER_TIMEOUT'] = float(os.environ.get('CONVERT_CHAPTER_TIMEOUT', '20'))
+
+# 批量转换：等待准入的总时间（整个压缩包共用），超时后剩余成员标记失败
+app.config['BULK_ADMISSION_TIMEOUT'] = float(os.environ.get('BULK_ADMISSION_TIMEOUT', '300'))
+# 批量转换：上传压缩包的大小上限（不受 MAX_CONTENT_LENGTH 限制）和压缩包中单个EPUB的大小上限
+app.config['BULK_MAX_ARCHIVE_SIZE'] = int(os.environ.get('BULK_MAX_ARCHIVE_SIZE_MB', '2048')) * 1024 * 1024
+app.config['BULK_MAX_MEMBER_SIZE'] = int(os.environ.get('BULK_MAX_MEMBER_SIZE_MB', '50')) * 1024 * 1024
+
+# 转换分析：按请求开启或按比例采样，产物通过管理接口下载
+app.config['PROFILE_FOLDER'] = 'profiles'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+app.config['PROFILE_MAX_COUNT'] = int(os.environ.get('PROFILE_MAX_COUNT', '50'))
+# 管理接口令牌，未设置时管理接口不可用
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN', '')
+
+# 文件元数据索引（SQLite）
+app.config['INDEX_DATABASE'] = os.environ.get('INDEX_DATABASE', 'data/file_index.db')
+
 # 确保目录存在
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['CONVERTED_FOLDER'], exist_ok=True)
+# 清理上次异常退出时未完成的转换留下的临时文件
+remove_stale_parts(app.config['CONVERTED_FOLDER'])
+
+admission = AdmissionController(
+    memory_budget=app.config['CONVERT_MEMORY_BUDGET'],
+    cpu_budget=app.config['CONVERT_CPU_BUDGET'],
+    max_concurrent=app.config['CONVERT_MAX_CONCURRENT'],
+    max_queue=app.config['CONVERT_MAX_QUEUE'],
+    queue_timeout=app.config['CONVERT_QUEUE_TIMEOUT']
+)
+
+file_index = FileIndex(app.config['INDEX_DATABASE'])
+file_index.import_existing(app.config['UPLOAD_FOLDER'], app.config['CONVERTED_FOLDER'])
+
+bulk_converter = BulkConverter(
+    admission,
+    file_index=file_index,
+    max_workers=app.config['CONVERT_MAX_CONCURRENT'],
+    max_member_size=app.config['BULK_MAX_MEMBER_SIZE'],
+    chapter_timeout=app.config['CONVERT_CHAPTER_TIMEOUT'],
+    time_budget=app.config['CONVERT_BOOK_TIMEOUT'],
+    admission_timeout=app.config['BULK_ADMISSION_TIMEOUT']
+)
+
+profiler = ConversionProfiler(
+    app.config['PROFILE_FOLDER'],
+    sample_rate=app.config['PROFILE_SAMPLE_RATE'],
+    max_profiles=app.config['PROFILE_MAX_COUNT']
+)
 
 # 允许的文件扩展名
 ALLOWED_EXTENSIONS = {'epub'}
@@ -36,6 +111,26 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def check_admin():
+    """校验管理接口令牌，失败时返回错误响应"""
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        return jsonify({
+            'success': False,
+            'error': '管理接口未启用'
+        }), 403
+    # 使用常量时间比较，避免通过响应时间猜测令牌
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), token.encode()):
+        return jsonify({
+            'success': False,
+            'error': '无权访问'
+        }), 401
+    return None
+
+def converted_name(record, fmt):
+    """根据原始文件名生成转换结果的下载文件名"""
+    return f"{os.path.splitext(record['fileName'])[0]}.{fmt}"
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """健康检查接口"""
@@ -46,6 +141,14 @@ def health_check():
         'timestamp': str(datetime.now())
     })
 
+@app.route('/stats', methods=['GET'])
+def admission_stats():
+    """转换队列和准入统计接口"""
+    return jsonify({
+        'success': True,
+        'admission': admission.get_stats()
+    })
+
 @app.route('/upload', methods=['POST'])
 def upload_epub():
     """EPUB文件上传接口（只保存，不转换）"""
@@ -78,15 +181,23 @@ def upload_epub():
         original_filename = file.filename  # 保留原始文件名，包括中文
         epub_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.epub")
         
-        # 保存上传的文件
-        file.save(epub_path)
+        # 保存上传的文件，同时计算大小和哈希
+        digest = hashlib.sha256()
+        file_size = 0
+        with open(epub_path, 'wb') as f:
+            for chunk in iter(lambda: file.stream.read(1024 * 1024), b''):
+                f.write(chunk)
+                digest.update(chunk)
+                file_size += len(chunk)
         logger.info(f"EPUB文件已保存: {epub_path}")
         
+        file_index.add_upload(file_id, original_filename, file_size, digest.hexdigest(), epub_path)
+        
         return jsonify({
             'success': True,
             'fileId': file_id,
             'fileName': original_filename,
-            'fileSize': file.content_length or 0,
+            'fileSize': file_size,
             'message': 'EPUB文件上传成功'
         })
             
@@ -115,12 +226,28 @@ def convert_epub():
                 'error': '文件ID列表不能为空'
             }), 400
         
+        # 可选的附加输出格式（TXT始终生成）
+        formats = data.get('formats', [])
+        if not isinstance(formats, list) or any(fmt not in EXTRA_WRITERS for fmt in formats):
+            return jsonify({
+                'success': False,
+                'error': f"不支持的输出格式，可选: {', '.join(EXTRA_WRITERS)}"
+            }), 400
+        formats = [fmt for fmt in EXTRA_WRITERS if fmt in formats]
+        
+        # 通过 X-Profile 请求头或 profile 参数开启分析，否则按比例采样
+        profile_requested = request.headers.get('X-Profile') == '1' or \
+                            request.args.get('profile') == '1' or \
+                            data.get('profile') is True
+        profiling = profiler.should_profile(profile_requested)
+        
         # 开始转换
         results = []
+        rejected = None
         for file_id in file_ids:
-            epub_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.epub")
+            record = file_index.get(file_id)
             
-            if not os.path.exists(epub_path):
+            if not record or not record['epubPath']:
                 results.append({
                     'fileId': file_id,
                     'success': False,
@@ -128,36 +255,100 @@ def convert_epub():
                 })
                 continue
             
-            # 转换EPUB为TXT
-            converter = EpubConverter()
-            result = converter.convert_to_txt(epub_path, app.config['CONVERTED_FOLDER'], file_id)
+            # 服务已饱和，剩余文件不再排队
+            if rejected:
+                results.append({
+                    'fileId': file_id,
+                    'success': False,
+                    'error': rejected.message,
+                    'retryAfter': rejected.retry_after
+                })
+                continue
+            
+            epub_path = record['epubPath']
             
-            if result['success']:
-                # 获取转换后文件的大小
-                converted_path = result['converted_path']
-                file_size = 0
-                if os.path.exists(converted_path):
-                    file_size = os.path.getsize(converted_path)
-                
+            # 转换EPUB为TXT（受准入控制）
+            converter = EpubConverter(chapter_timeout=app.config['CONVERT_CHAPTER_TIMEOUT'])
+            
+            def convert(*args, **kwargs):
+                # 通过准入后才标记为转换中，被拒绝时保留原有状态和转换结果
+                file_index.mark_converting(file_id)
+                return converter.convert_to_txt(*args, **kwargs)
+            
+            convert_args = (epub_path, app.config['CONVERTED_FOLDER'], file_id)
+            convert_kwargs = {
+                'time_budget': app.config['CONVERT_BOOK_TIMEOUT'],
+                'formats': formats
+            }
+            try:
+                if profiling:
+                    result = admission.run(
+                        admission.estimate_cost(epub_path),
+                        profiler.run, file_id, converter, convert,
+                        *convert_args, **convert_kwargs
+                    )
+                else:
+                    result = admission.run(
+                        admission.estimate_cost(epub_path),
+                        convert,
+                        *convert_args, **convert_kwargs
+                    )
+            except AdmissionRejected as e:
+                logger.warning(f"转换请求被拒绝: {e.message}")
+                rejected = e
+                if not results:
+                    # 尚未处理任何文件，直接快速失败
+                    response = jsonify({
+                        'success': False,
+                        'error': e.message,
+                        'retryAfter': e.retry_after
+                    })
+                    response.headers['Retry-After'] = str(e.retry_after)
+                    return response, e.status_code
                 results.append({
                     'fileId': file_id,
-                    'success': True,
-                    'fileName': f"{file_id}.txt",
-                    'fileSize': file_size,
-                    'message': 'EPUB转换成功'
+                    'success': False,
+                    'error': e.message,
+                    'retryAfter': e.retry_after
                 })
+                continue
+            
+            file_index.record_conversion(file_id, result)
+            
+            if result['success']:
+                entry = {
+                    'fileId': file_id,
+                    'success': True,
+                    'fileName': converted_name(record, 'txt'),
+                    'fileSize': os.path.getsize(result['converted_path']),
+                    'partial': result['timed_out'],
+                    'chaptersCount': result['chapters_count'],
+                    'spineItems': result['spine_items'],
+                    'outputs': {fmt: os.path.basename(path) for fmt, path in result['outputs'].items()},
+                    'message': 'EPUB转换超时，已保存部分内容' if result['timed_out'] else 'EPUB转换成功'
+                }
             else:
-                results.append({
+                entry = {
                     'fileId': file_id,
                     'success': False,
+                    'timedOut': result.get('timed_out', False),
                     'error': result['error']
-                })
+                }
+            if 'profile_id' in result:
+                entry['profileId'] = result['profile_id']
+            elif profile_requested and result.get('profile_skipped'):
+                # 显式请求的分析因已有分析在进行而未执行
+                entry['profileSkipped'] = True
+            results.append(entry)
         
-        return jsonify({
+        response = jsonify({
             'success': True,
             'results': results,
             'message': f'批量转换完成，共处理 {len(file_ids)} 个文件'
         })
+        if rejected:
+            response.headers['Retry-After'] = str(rejected.retry_after)
+        return response
             
     except Exception as e:
         logger.error(f"转换过程中发生错误: {str(e)}")
@@ -166,23 +357,115 @@ def convert_epub():
             'error': f'服务器内部错误: {str(e)}'
         }), 500
 
+@app.route('/bulk-convert', methods=['POST'])
+def bulk_convert():
+    """批量转换接口：上传一个包含多个EPUB的ZIP压缩包
+
+    表单参数:
+        archive: ZIP压缩包
+        formats: 可选，逗号分隔的附加输出格式（如 jsonl,md）
+        output: manifest（默认，返回JSON清单）或 archive（返回结果压缩包）
+    """
+    try:
+        if 'archive' not in request.files:
+            return jsonify({
+                'success': False,
+                'error': '没有上传压缩包'
+            }), 400
+        
+        archive = request.files['archive']
+        if not archive.filename.lower().endswith('.zip'):
+            return jsonify({
+                'success': False,
+                'error': '只支持ZIP压缩包'
+            }), 400
+        
+        formats = [fmt for fmt in request.form.get('formats', '').split(',') if fmt]
+        if any(fmt not in EXTRA_WRITERS for fmt in formats):
+            return jsonify({
+                'success': False,
+                'error': f"不支持的输出格式，可选: {', '.join(EXTRA_WRITERS)}"
+            }), 400
+        formats = [fmt for fmt in EXTRA_WRITERS if fmt in formats]
+        
+        output = request.form.get('output', 'manifest')
+        if output not in ('manifest', 'archive'):
+            return jsonify({
+                'success': False,
+                'error': '不支持的返回方式'
+            }), 400
+        
+        # 压缩包不另存到 uploads，成员不解压到磁盘；
+        # 注意超过500KB的上传文件会由 Werkzeug 先缓存到系统临时目录，请求结束后删除
+        try:
+            manifest = bulk_converter.convert_archive(archive.stream, app.config['CONVERTED_FOLDER'], formats)
+        except zipfile.BadZipFile:
+            return jsonify({
+                'success': False,
+                'error': '压缩包已损坏或格式不正确'
+            }), 400
+        
+        succeeded = sum(1 for entry in manifest if entry['success'])
+        logger.info(f"批量转换完成: {succeeded}/{len(manifest)} 个文件成功")
+        # 部分成员等待准入超时，提示客户端稍后重试
+        retry_after = max((entry['retryAfter'] for entry in manifest if 'retryAfter' in entry), default=None)
+        
+        if output == 'archive':
+            result_file = tempfile.TemporaryFile()
+            BulkConverter.write_result_archive(manifest, app.config['CONVERTED_FOLDER'], result_file)
+            result_file.seek(0)
+            response = send_file(
+                result_file,
+                as_attachment=True,
+                download_name='converted.zip',
+                mimetype='application/zip'
+            )
+        else:
+            response = jsonify({
+                'success': True,
+                'results': manifest,
+                'message': f'批量转换完成，共处理 {len(manifest)} 个文件，成功 {succeeded} 个'
+            })
+        
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
+        
+    except Exception as e:
+        logger.error(f"批量转换过程中发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'服务器内部错误: {str(e)}'
+        }), 500
+
 @app.route('/download/<file_id>', methods=['GET'])
 def download_file(file_id):
-    """下载转换后的文件"""
+    """下载转换后的文件，可通过 format 参数选择 txt/jsonl/md"""
     try:
-        txt_path = os.path.join(app.config['CONVERTED_FOLDER'], f"{file_id}.txt")
+        fmt = request.args.get('format', 'txt')
+        if fmt not in OUTPUT_MIMETYPES:
+            return jsonify({
+                'success': False,
+                'error': '不支持的输出格式'
+            }), 400
         
-        if not os.path.exists(txt_path):
+        record = file_index.get(file_id)
+        
+        # 按最近一次成功的转换判断，重新转换进行中或失败时仍可下载
+        file_path = os.path.abspath(output_path(app.config['CONVERTED_FOLDER'], file_id, fmt))
+        # 索引记录存在但文件已从磁盘删除时同样返回404
+        if not record or not record['convertedAt'] or fmt not in record['outputs'] \
+                or not os.path.exists(file_path):
             return jsonify({
                 'success': False,
                 'error': '文件不存在'
             }), 404
         
         return send_file(
-            txt_path,
+            file_path,
             as_attachment=True,
-            download_name=f"{file_id}.txt",
-            mimetype='text/plain'
+            download_name=converted_name(record, fmt),
+            mimetype=OUTPUT_MIMETYPES[fmt]
         )
         
     except Exception as e:
@@ -196,16 +479,22 @@ def download_file(file_id):
 def preview_file(file_id):
     """预览转换后的文件内容（前1000字符）"""
     try:
-        txt_path = os.path.join(app.config['CONVERTED_FOLDER'], f"{file_id}.txt")
+        record = file_index.get(file_id)
         
-        if not os.path.exists(txt_path):
+        if not record or not record['convertedAt']:
             return jsonify({
                 'success': False,
                 'error': '文件不存在'
             }), 404
         
-        with open(txt_path, 'r', encoding='utf-8') as f:
-            content = f.read(1000)
+        try:
+            with open(record['convertedPath'], 'r', encoding='utf-8') as f:
+                content = f.read(1000)
+        except FileNotFoundError:
+            return jsonify({
+                'success': False,
+                'error': '文件不存在'
+            }), 404
         
         return jsonify({
             'success': True,
@@ -220,6 +509,149 @@ def preview_file(file_id):
             'error': f'预览失败: {str(e)}'
         }), 500
 
+@app.route('/files', methods=['GET'])
+def list_files():
+    """分页列出文件及其转换状态
+
+    查询参数:
+        status: 可选，按状态过滤（uploaded/converting/converted/partial/failed）
+        limit: 每页数量，默认50，最大500
+        offset: 偏移量，默认0
+    """
+    try:
+        status = request.args.get('status') or None
+        try:
+            limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+            offset = max(int(request.args.get('offset', 0)), 0)
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': '分页参数无效'
+            }), 400
+        
+        records, total = file_index.list_files(status, limit, offset)
+        
+        return jsonify({
+            'success': True,
+            'files': [public_record(record) for record in records],
+            'total': total,
+            'limit': limit,
+            'offset': offset
+        })
+        
+    except Exception as e:
+        logger.error(f"获取文件列表时发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'获取失败: {str(e)}'
+        }), 500
+
+@app.route('/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    """查询单个文件的元数据、转换状态和章节偏移"""
+    try:
+        record = file_index.get(file_id)
+        if not record:
+            return jsonify({
+                'success': False,
+                'error': '文件不存在'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'file': public_record(record),
+            'chapters': file_index.get_chapters(file_id)
+        })
+        
+    except Exception as e:
+        logger.error(f"查询文件时发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'查询失败: {str(e)}'
+        }), 500
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """列出已保存的转换分析"""
+    error = check_admin()
+    if error:
+        return error
+    
+    try:
+        return jsonify({
+            'success': True,
+            'profiles': profiler.list_profiles()
+        })
+        
+    except Exception as e:
+        logger.error(f"获取转换分析列表时发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'获取失败: {str(e)}'
+        }), 500
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def get_profile(profile_id):
+    """获取转换分析摘要（各阶段耗时、热点函数、内存分配）"""
+    error = check_admin()
+    if error:
+        return error
+    
+    try:
+        summary = profiler.get_summary(profile_id)
+        if not summary:
+            return jsonify({
+                'success': False,
+                'error': '分析不存在'
+            }), 404
+        
+        return jsonify({
+            'success': True,
+            'profile': summary
+        })
+        
+    except Exception as e:
+        logger.error(f"获取转换分析时发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'获取失败: {str(e)}'
+        }), 500
+
+@app.route('/admin/profiles/<profile_id>/<artifact>', methods=['GET'])
+def download_profile(profile_id, artifact):
+    """下载原始分析数据：prof（cProfile）或 snapshot（tracemalloc）"""
+    error = check_admin()
+    if error:
+        return error
+    
+    try:
+        if artifact not in PROFILE_ARTIFACTS:
+            return jsonify({
+                'success': False,
+                'error': '不支持的分析数据类型'
+            }), 400
+        
+        artifact_path = profiler.artifact_path(profile_id, artifact)
+        if not artifact_path or not os.path.exists(artifact_path):
+            return jsonify({
+                'success': False,
+                'error': '分析不存在'
+            }), 404
+        
+        return send_file(
+            os.path.abspath(artifact_path),
+            as_attachment=True,
+            download_name=f"{profile_id}.{artifact}",
+            mimetype=PROFILE_ARTIFACTS[artifact]
+        )
+        
+    except Exception as e:
+        logger.error(f"下载转换分析时发生错误: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': f'下载失败: {str(e)}'
+        }), 500
+
 if __name__ == '__main__':
     from datetime import datetime
     # 生产环境应该设置为 False
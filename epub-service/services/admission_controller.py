@@ -0,0 +1,248 @@
+import os
+import re
+import time
+import zipfile
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# 解析树、清理后的文本等中间结果相对于解压后内容的膨胀系数
+MEMORY_EXPANSION_FACTOR = 6
+# 每个转换任务的基础内存开销（解释器对象、ebooklib结构等）
+BASE_JOB_MEMORY = 8 * 1024 * 1024
+
+
+class AdmissionRejected(Exception):
+    """转换任务被准入控制拒绝"""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    """排队中的转换任务"""
+
+    def __init__(self, memory, cpu):
+        self.memory = memory
+        self.cpu = cpu
+        self.admitted = False
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    """转换任务准入控制器
+
+    按内存预算、CPU预算（以章节数计）和并发数限制同时进行的转换，超出部分按先进先出排队，
+    队列已满或等待超时时直接拒绝，由调用方返回 429/503 和 Retry-After。
+    批量转换等后台任务通过 acquire_background 等待，优先级低于排队中的交互请求。
+    """
+
+    def __init__(self, memory_budget, cpu_budget, max_concurrent, max_queue, queue_timeout):
+        self.memory_budget = memory_budget
+        self.cpu_budget = max(1, cpu_budget)
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._running = 0
+        self._memory_in_use = 0
+        self._cpu_in_use = 0
+        # 后台任务（批量转换）不进入排队队列，单独计数
+        self._background_waiting = 0
+
+        # 统计信息
+        self._admitted_total = 0
+        self._rejected_queue_full = 0
+        self._rejected_timeout = 0
+        self._wait_time_total = 0.0
+        self._avg_job_seconds = 5.0
+
+    def estimate_cost(self, epub_path):
+        """
+        根据EPUB大小和阅读顺序长度估算转换开销
+
+        Args:
+            epub_path: EPUB文件路径或已打开的文件对象
+
+        Returns:
+            dict: 预计内存占用(字节)和CPU开销(章节数)
+        """
+        uncompressed_size = 0
+        spine_length = 0
+
+        try:
+            with zipfile.ZipFile(epub_path) as zf:
+                opf_name = None
+                for info in zf.infolist():
+                    uncompressed_size += info.file_size
+                    if info.filename.lower().endswith('.opf'):
+                        opf_name = info.filename
+
+                if opf_name:
+                    opf_content = zf.read(opf_name).decode('utf-8', errors='ignore')
+                    spine_length = len(re.findall(r'<(?:\w+:)?itemref\b', opf_content))
+        except Exception as e:
+            # 无法解析的文件按磁盘大小粗略估算，实际错误留给转换器报告
+            logger.warning(f"估算转换开销失败: {str(e)}")
+            if isinstance(epub_path, str):
+                uncompressed_size = os.path.getsize(epub_path) if os.path.exists(epub_path) else 0
+
+        return {
+            'memory': BASE_JOB_MEMORY + uncompressed_size * MEMORY_EXPANSION_FACTOR,
+            'cpu': max(spine_length, 1)
+        }
+
+    def acquire(self, cost):
+        """
+        申请执行一个转换任务，必要时排队等待
+
+        Args:
+            cost: estimate_cost 返回的开销
+
+        Returns:
+            _Ticket: 准入凭证，需通过 release 归还
+
+        Raises:
+            AdmissionRejected: 队列已满或等待超时
+        """
+        # 超过整体预算的任务按预算计，保证它在空闲时仍能执行
+        ticket = _Ticket(min(cost['memory'], self.memory_budget), min(cost['cpu'], self.cpu_budget))
+
+        with self._cond:
+            if not self._queue and self._fits(ticket):
+                self._admit(ticket)
+                return ticket
+
+            if len(self._queue) >= self.max_queue:
+                self._rejected_queue_full += 1
+                raise AdmissionRejected('服务繁忙，请稍后重试', 429, self._retry_after())
+
+            self._queue.append(ticket)
+            deadline = ticket.enqueued_at + self.queue_timeout
+
+            while True:
+                if self._queue[0] is ticket and self._fits(ticket):
+                    self._queue.popleft()
+                    self._admit(ticket)
+                    # 唤醒下一个排队任务，它可能也能放得下
+                    self._cond.notify_all()
+                    return ticket
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._queue.remove(ticket)
+                    self._rejected_timeout += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected('排队等待超时，请稍后重试', 503, self._retry_after())
+
+                self._cond.wait(remaining)
+
+    def acquire_background(self, cost, timeout):
+        """
+        以后台优先级申请执行任务：不占用排队名额，
+        只在排队队列为空且预算允许时执行，交互请求始终优先
+
+        Args:
+            cost: estimate_cost 返回的开销
+            timeout: 最长等待秒数
+
+        Returns:
+            _Ticket: 准入凭证，需通过 release 归还
+
+        Raises:
+            AdmissionRejected: 等待超时
+        """
+        ticket = _Ticket(min(cost['memory'], self.memory_budget), min(cost['cpu'], self.cpu_budget))
+        deadline = ticket.enqueued_at + max(timeout, 0)
+
+        with self._cond:
+            self._background_waiting += 1
+            try:
+                while self._queue or not self._fits(ticket):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._rejected_timeout += 1
+                        raise AdmissionRejected('等待转换超时，请稍后重试', 503, self._retry_after())
+                    self._cond.wait(remaining)
+                self._admit(ticket)
+            finally:
+                self._background_waiting -= 1
+            return ticket
+
+    def release(self, ticket, elapsed=None):
+        """归还准入凭证，并记录任务耗时用于估算 Retry-After"""
+        with self._cond:
+            if not ticket.admitted:
+                return
+            ticket.admitted = False
+            self._running -= 1
+            self._memory_in_use -= ticket.memory
+            self._cpu_in_use -= ticket.cpu
+            if elapsed is not None:
+                self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * elapsed
+            self._cond.notify_all()
+
+    def run(self, cost, func, *args, **kwargs):
+        """在准入控制下执行 func，返回其结果"""
+        return self._run(self.acquire(cost), func, *args, **kwargs)
+
+    def run_background(self, cost, timeout, func, *args, **kwargs):
+        """以后台优先级执行 func，最多等待 timeout 秒"""
+        return self._run(self.acquire_background(cost, timeout), func, *args, **kwargs)
+
+    def _run(self, ticket, func, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.release(ticket, time.monotonic() - started)
+
+    def get_stats(self):
+        """获取队列和准入统计信息"""
+        with self._cond:
+            return {
+                'running': self._running,
+                'queued': len(self._queue),
+                'backgroundWaiting': self._background_waiting,
+                'maxConcurrent': self.max_concurrent,
+                'maxQueue': self.max_queue,
+                'memoryInUse': self._memory_in_use,
+                'memoryBudget': self.memory_budget,
+                'cpuInUse': self._cpu_in_use,
+                'cpuBudget': self.cpu_budget,
+                'admittedTotal': self._admitted_total,
+                'rejectedQueueFull': self._rejected_queue_full,
+                'rejectedTimeout': self._rejected_timeout,
+                'avgWaitSeconds': round(self._wait_time_total / self._admitted_total, 3)
+                if self._admitted_total else 0.0,
+                'avgJobSeconds': round(self._avg_job_seconds, 3)
+            }
+
+    def _fits(self, ticket):
+        """判断任务在当前预算下能否执行（调用方需持有锁）"""
+        if self._running >= self.max_concurrent:
+            return False
+        if self._cpu_in_use + ticket.cpu > self.cpu_budget:
+            return False
+        return self._memory_in_use + ticket.memory <= self.memory_budget
+
+    def _admit(self, ticket):
+        """登记准入的任务（调用方需持有锁）"""
+        ticket.admitted = True
+        self._running += 1
+        self._memory_in_use += ticket.memory
+        self._cpu_in_use += ticket.cpu
+        self._admitted_total += 1
+        self._wait_time_total += time.monotonic() - ticket.enqueued_at
+
+    def _retry_after(self):
+        """根据排队长度和平均耗时估算重试等待秒数（调用方需持有锁）"""
+        waves = (len(self._queue) + self._running) / self.max_concurrent
+        return max(1, int(waves * self._avg_job_seconds + 0.5))
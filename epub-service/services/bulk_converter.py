@@ -0,0 +1,220 @@
+import io
+import os
+import re
+import json
+import hashlib
+import time
+import uuid
+import logging
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from .epub_converter import EpubConverter
+from .admission_controller import AdmissionRejected, MEMORY_EXPANSION_FACTOR
+
+logger = logging.getLogger(__name__)
+
+# 结果压缩包文件名中需要替换的字符
+UNSAFE_NAME_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+
+class BulkConverter:
+    """批量转换ZIP压缩包中的EPUB文件
+
+    逐个读取压缩包成员到内存后交给线程池转换，不解压到磁盘；
+    同时在途的成员数和字节数都有上限，避免整个压缩包被读入内存。
+    成员以后台优先级通过准入控制，不占用排队名额；整个压缩包共用 admission_timeout 的等待时间，
+    超时后剩余成员在清单中标记失败并附带 retryAfter。
+    """
+
+    def __init__(self, admission, max_workers, max_member_size, chapter_timeout, time_budget=None,
+                 file_index=None, admission_timeout=300):
+        self.admission = admission
+        self.admission_timeout = admission_timeout
+        self.file_index = file_index
+        self.max_workers = max(1, max_workers)
+        self.max_member_size = max_member_size
+        self.chapter_timeout = chapter_timeout
+        self.time_budget = time_budget
+        # 在途成员（读入内存但尚未转换完）的总字节数上限，按内存预算折算，至少允许一个成员
+        self.max_inflight_bytes = admission.memory_budget // MEMORY_EXPANSION_FACTOR
+
+    def convert_archive(self, archive, output_dir, formats=()):
+        """
+        转换压缩包中的所有EPUB文件
+
+        Args:
+            archive: ZIP文件路径或可随机读取的文件对象
+            output_dir: 输出目录
+            formats: 除TXT外需要同时生成的格式
+
+        Returns:
+            list: 每个EPUB成员的转换结果（按压缩包中的顺序）
+        """
+        manifest = []
+        # 在途任务及其占用的字节数
+        pending = {}
+        inflight_bytes = 0
+        # 所有成员等待准入的截止时间
+        admission_deadline = time.monotonic() + self.admission_timeout
+
+        with zipfile.ZipFile(archive) as zf:
+            members = [info for info in zf.infolist() if self._is_epub_member(info)]
+            logger.info(f"压缩包中共有 {len(members)} 个EPUB文件")
+
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for index, info in enumerate(members):
+                    if info.file_size > self.max_member_size:
+                        manifest.append({
+                            'index': index,
+                            'member': info.filename,
+                            'success': False,
+                            'error': '文件过大'
+                        })
+                        continue
+
+                    # 在途成员数或字节数达到上限时先等待部分完成
+                    while pending and (len(pending) >= self.max_workers * 2
+                                       or inflight_bytes + info.file_size > self.max_inflight_bytes):
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            inflight_bytes -= pending.pop(future)
+                            manifest.append(future.result())
+
+                    try:
+                        data = zf.read(info)
+                    except Exception as e:
+                        logger.warning(f"读取压缩包成员 {info.filename} 失败: {str(e)}")
+                        manifest.append({
+                            'index': index,
+                            'member': info.filename,
+                            'success': False,
+                            'error': f'读取失败: {str(e)}'
+                        })
+                        continue
+
+                    future = pool.submit(
+                        self._convert_member, index, info.filename, data, output_dir, formats, admission_deadline
+                    )
+                    pending[future] = len(data)
+                    inflight_bytes += len(data)
+
+                done, _ = wait(pending)
+                manifest.extend(future.result() for future in done)
+
+        manifest.sort(key=lambda entry: entry['index'])
+        return manifest
+
+    def _convert_member(self, index, member, data, output_dir, formats, admission_deadline):
+        """转换单个压缩包成员"""
+        file_id = str(uuid.uuid4())
+        source = io.BytesIO(data)
+        converter = EpubConverter(chapter_timeout=self.chapter_timeout)
+
+        if self.file_index:
+            self.file_index.add_upload(
+                file_id, os.path.basename(member), len(data), hashlib.sha256(data).hexdigest()
+            )
+
+        # 成员内容本身也留在内存中，计入内存开销
+        cost = self.admission.estimate_cost(source)
+        cost['memory'] += len(data)
+
+        try:
+            result = self.admission.run_background(
+                cost,
+                admission_deadline - time.monotonic(),
+                self._run_conversion,
+                converter, source, output_dir, file_id, formats
+            )
+        except AdmissionRejected as e:
+            if self.file_index:
+                self.file_index.mark_failed(file_id, e.message)
+            return {
+                'index': index,
+                'member': member,
+                'success': False,
+                'error': e.message,
+                'retryAfter': e.retry_after
+            }
+        except Exception as e:
+            logger.error(f"转换压缩包成员 {member} 失败: {str(e)}")
+            if self.file_index:
+                self.file_index.mark_failed(file_id, f'转换失败: {str(e)}')
+            return {
+                'index': index,
+                'member': member,
+                'success': False,
+                'error': f'转换失败: {str(e)}'
+            }
+
+        if self.file_index:
+            self.file_index.record_conversion(file_id, result)
+
+        if not result['success']:
+            return {
+                'index': index,
+                'member': member,
+                'success': False,
+                'timedOut': result.get('timed_out', False),
+                'error': result['error']
+            }
+
+        return {
+            'index': index,
+            'member': member,
+            'fileId': file_id,
+            'success': True,
+            'fileSize': os.path.getsize(result['converted_path']),
+            'partial': result['timed_out'],
+            'chaptersCount': result['chapters_count'],
+            'spineItems': result['spine_items'],
+            'outputs': {fmt: os.path.basename(path) for fmt, path in result['outputs'].items()}
+        }
+
+    def _run_conversion(self, converter, source, output_dir, file_id, formats):
+        """通过准入后执行转换，此时才标记为转换中"""
+        if self.file_index:
+            self.file_index.mark_converting(file_id)
+        return converter.convert_to_txt(
+            source, output_dir, file_id,
+            time_budget=self.time_budget,
+            formats=formats
+        )
+
+    def _is_epub_member(self, info):
+        """判断压缩包成员是否为需要转换的EPUB文件"""
+        name = info.filename
+        if info.is_dir() or name.startswith('__MACOSX/'):
+            return False
+        return os.path.basename(name).lower().endswith('.epub')
+
+    @staticmethod
+    def write_result_archive(manifest, output_dir, target):
+        """
+        将转换结果和清单打包为ZIP
+
+        Args:
+            manifest: convert_archive 返回的结果列表
+            output_dir: 转换结果所在目录
+            target: 写入ZIP的文件对象
+        """
+        with zipfile.ZipFile(target, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+            for entry in manifest:
+                if not entry['success']:
+                    continue
+                stem = BulkConverter._archive_stem(entry['index'], entry['member'])
+                for fmt, file_name in entry['outputs'].items():
+                    zf.write(os.path.join(output_dir, file_name), f"{stem}.{fmt}")
+            zf.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    @staticmethod
+    def _archive_stem(index, member):
+        """
+        生成结果压缩包中的文件名（不含扩展名）
+
+        只保留成员的文件名部分并替换不安全字符，以序号开头避免重名和路径穿越
+        """
+        name = re.split(r'[\\/]', member)[-1]
+        stem = os.path.splitext(name)[0]
+        stem = UNSAFE_NAME_CHARS.sub('_', stem).strip().lstrip('.')
+        return f"{index}-{stem or 'book'}"
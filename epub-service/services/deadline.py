@@ -0,0 +1,47 @@
+import time
+
+
+class ConversionTimeout(Exception):
+    """转换超过整本书的时间预算"""
+
+    def __init__(self, message='转换超时'):
+        super().__init__(message)
+        self.message = message
+
+
+class Deadline:
+    """转换时间预算
+
+    整本书使用一个根预算，每个章节从中派生子预算。子预算到期只表示
+    该章节应降级为快速处理；根预算到期时 check() 抛出 ConversionTimeout，
+    由调用方在安全点协作式地取消转换。
+    """
+
+    def __init__(self, seconds=None, parent=None):
+        self.parent = parent
+        self.expires_at = None if seconds is None else time.monotonic() + seconds
+        if parent is not None and parent.expires_at is not None:
+            if self.expires_at is None or parent.expires_at < self.expires_at:
+                self.expires_at = parent.expires_at
+
+    def child(self, seconds):
+        """派生一个不晚于当前预算的子预算"""
+        return Deadline(seconds, parent=self)
+
+    def remaining(self):
+        """剩余秒数，无限制时返回 None"""
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """当前预算（含父预算）是否已用完"""
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def check(self):
+        """整本书的预算用完时抛出 ConversionTimeout"""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        if root.expired():
+            raise ConversionTimeout()
@@ -1,73 +1,138 @@
 import os
+import html
 import logging
 import chardet
 from ebooklib import epub
 from bs4 import BeautifulSoup
 import re
 from .text_processor import TextProcessor
+from .deadline import Deadline, ConversionTimeout
+from .output_writers import TxtWriter, EXTRA_WRITERS, output_path
+from .profiler import NULL_STAGE_TIMER
 
 logger = logging.getLogger(__name__)
 
+# 单个章节的默认处理时间（秒），超出后该章节剩余内容降级处理
+DEFAULT_CHAPTER_TIMEOUT = 20
+# 超过该大小（字符数）的章节HTML不再用html.parser解析，改用正则去除标签
+LARGE_CHAPTER_SIZE = 2 * 1024 * 1024
+
 class EpubConverter:
     """EPUB转TXT转换器"""
     
-    def __init__(self):
+    def __init__(self, chapter_timeout=DEFAULT_CHAPTER_TIMEOUT, large_chapter_size=LARGE_CHAPTER_SIZE):
         self.text_processor = TextProcessor()
+        self.chapter_timeout = chapter_timeout
+        self.large_chapter_size = large_chapter_size
+        # 分析模式下由 ConversionProfiler 替换为 StageTimer
+        self.stage_timer = NULL_STAGE_TIMER
     
-    def convert_to_txt(self, epub_path, output_dir, file_id):
+    def convert_to_txt(self, epub_path, output_dir, file_id, time_budget=None, formats=()):
         """
-        将EPUB文件转换为TXT文件
+        将EPUB文件转换为TXT文件，并可在同一次提取中生成其他格式
         
         Args:
-            epub_path: EPUB文件路径
+            epub_path: EPUB文件路径，也可以是已在内存中的文件对象
             output_dir: 输出目录
             file_id: 文件ID
+            time_budget: 整本书的时间预算（秒），None 表示不限制；
+                超时后保存已完成的章节并标记为部分结果
+            formats: 除TXT外需要同时生成的格式，如 ('jsonl', 'md')
             
         Returns:
             dict: 转换结果
         """
+        deadline = Deadline(time_budget)
+        timed_out = False
+        chapters_count = 0
+        # 每个章节的标题及其在TXT文件中的字节偏移和长度
+        chapter_index = []
+        writers = []
+        
         try:
             logger.info(f"开始转换EPUB文件: {epub_path}")
             
             # 读取EPUB文件
-            book = epub.read_epub(epub_path)
+            with self.stage_timer.stage('read_epub'):
+                book = epub.read_epub(epub_path)
             
             # 提取元数据
-            metadata = self._extract_metadata(book)
+            with self.stage_timer.stage('metadata'):
+                metadata = self._extract_metadata(book)
             logger.info(f"提取到元数据: {metadata}")
             
-            # 提取所有章节内容
-            chapters = self._extract_chapters(book)
-            logger.info(f"提取到 {len(chapters)} 个章节")
+            # 打开各格式的输出，章节提取后立即写入，不在内存中合并全文
+            txt_writer = TxtWriter(output_path(output_dir, file_id, TxtWriter.extension))
+            writers.append(txt_writer)
+            for fmt in formats:
+                writers.append(EXTRA_WRITERS[fmt](output_path(output_dir, file_id, fmt)))
             
-            # 合并章节内容
-            full_text = self._merge_chapters(chapters, metadata)
+            for writer in writers:
+                writer.begin(metadata)
             
-            # 检测和转换编码
-            text_utf8 = self._ensure_utf8(full_text)
-            
-            # 保存为TXT文件
-            txt_path = os.path.join(output_dir, f"{file_id}.txt")
-            with open(txt_path, 'w', encoding='utf-8') as f:
-                f.write(text_utf8)
-            
-            logger.info(f"转换完成，保存到: {txt_path}")
+            try:
+                for chapter in self._iter_chapters(book, deadline):
+                    # 检测和转换编码
+                    chapter['content'] = self._ensure_utf8(chapter['content'])
+                    
+                    with self.stage_timer.stage('write'):
+                        offset, length = txt_writer.write_chapter(chapters_count, chapter)
+                        for writer in writers[1:]:
+                            writer.write_chapter(chapters_count, chapter, offset, length)
+                    chapter_index.append({
+                        'title': chapter['title'],
+                        'offset': offset,
+                        'length': length
+                    })
+                    chapters_count += 1
+            except ConversionTimeout:
+                timed_out = True
+                logger.warning(f"转换超时，已完成 {chapters_count} 个章节")
+            
+            for writer in writers:
+                writer.close()
+            
+            if timed_out and chapters_count == 0:
+                self._discard_outputs(writers)
+                return {
+                    'success': False,
+                    'error': '转换超时',
+                    'timed_out': True
+                }
+            
+            # 全部写完后再替换最终文件，失败时保留上一次的转换结果
+            for writer in writers:
+                writer.commit()
+            
+            logger.info(f"转换完成，共 {chapters_count} 个章节，保存到: {txt_writer.path}")
             
             return {
                 'success': True,
-                'converted_path': txt_path,
-                'text_length': len(text_utf8),
-                'chapters_count': len(chapters),
-                'metadata': metadata
+                'converted_path': txt_writer.path,
+                'outputs': {writer.extension: writer.path for writer in writers},
+                'text_length': txt_writer.text_length,
+                'chapters_count': chapters_count,
+                'chapters': chapter_index,
+                'metadata': metadata,
+                'timed_out': timed_out,
+                'spine_items': len(book.spine)
             }
             
         except Exception as e:
             logger.error(f"EPUB转换失败: {str(e)}")
+            for writer in writers:
+                writer.close()
+            self._discard_outputs(writers)
             return {
                 'success': False,
                 'error': f'转换失败: {str(e)}'
             }
     
+    def _discard_outputs(self, writers):
+        """删除未完成的临时输出文件"""
+        for writer in writers:
+            writer.discard()
+    
     def _extract_metadata(self, book):
         """提取EPUB元数据"""
         metadata = {
@@ -104,9 +169,11 @@ class EpubConverter:
         
         return metadata
     
-    def _extract_chapters(self, book):
-        """提取所有章节内容"""
-        chapters = []
+    def _iter_chapters(self, book, deadline=None):
+        """按阅读顺序逐个生成章节，整本书超时时抛出 ConversionTimeout"""
+        chapters_found = 0
+        if deadline is None:
+            deadline = Deadline()
         
         try:
             # 首先尝试使用阅读顺序（spine）来获取章节
@@ -125,25 +192,26 @@ class EpubConverter:
                 for i, (item_id, linear) in enumerate(book.spine):
                     try:
                         # 根据ID获取对应的item
+                        deadline.check()
                         item = items_dict.get(item_id)
                         if item and hasattr(item, 'get_content'):
                             content = item.get_content()
                             if content:
                                 html_content = content.decode('utf-8')
-                                chapter_text = self._extract_text_from_html(html_content)
+                                chapter = self._extract_chapter(html_content, deadline)
                                 
-                                if chapter_text.strip():
-                                    chapters.append({
-                                        'title': self._extract_chapter_title(html_content),
-                                        'content': chapter_text
-                                    })
-                                    logger.info(f"提取章节 {i+1}: {chapters[-1]['title']}")
+                                if chapter:
+                                    chapters_found += 1
+                                    logger.info(f"提取章节 {i+1}: {chapter['title']}")
+                                    yield chapter
+                    except ConversionTimeout:
+                        raise
                     except Exception as e:
                         logger.warning(f"处理阅读顺序项目 {item_id} 时出错: {str(e)}")
                         continue
             
             # 如果阅读顺序为空，回退到原来的方法
-            if not chapters:
+            if not chapters_found:
                 logger.info("阅读顺序为空，使用传统方法提取章节")
                 
                 # 获取所有文档
@@ -160,39 +228,88 @@ class EpubConverter:
                             is_document = True
                     
                     if is_document:
+                        deadline.check()
                         # 解析HTML内容
                         html_content = item.get_content().decode('utf-8')
-                        chapter_text = self._extract_text_from_html(html_content)
+                        chapter = self._extract_chapter(html_content, deadline)
                         
-                        if chapter_text.strip():
-                            chapters.append({
-                                'title': self._extract_chapter_title(html_content),
-                                'content': chapter_text
-                            })
+                        if chapter:
+                            chapters_found += 1
+                            yield chapter
                             
+        except ConversionTimeout:
+            raise
         except Exception as e:
             logger.error(f"提取章节时出错: {str(e)}")
+    
+    def _extract_chapter(self, html_content, deadline):
+        """在章节时间预算内提取单个章节，超大章节跳过HTML解析"""
+        chapter_deadline = deadline.child(self.chapter_timeout)
+        
+        if len(html_content) > self.large_chapter_size:
+            logger.warning(f"章节过大（{len(html_content)} 字符），跳过HTML解析直接去除标签")
+            chapter_text = self._extract_text_fast(html_content, chapter_deadline)
+            with self.stage_timer.stage('extract_title'):
+                title = self._extract_chapter_title_fast(html_content)
+        else:
+            chapter_text = self._extract_text_from_html(html_content, chapter_deadline)
+            with self.stage_timer.stage('extract_title'):
+                title = self._extract_chapter_title(html_content)
+        
+        if not chapter_text.strip():
+            return None
         
-        return chapters
+        return {
+            'title': title,
+            'content': chapter_text
+        }
+    
+    def _extract_text_fast(self, html_content, deadline=None):
+        """用正则去除标签提取文本，避免为超大章节构建完整的解析树
+
+        与 get_text() 一致，标签直接去掉而不替换为空格（否则行内标签会在中文之间插入空格），
+        并解码全部HTML实体
+        """
+        with self.stage_timer.stage('parse_html'):
+            text = re.sub(r'(?is)<(script|style)\b.*?</\1\s*>', '', html_content)
+            text = re.sub(r'(?s)<!--.*?-->', '', text)
+            text = html.unescape(re.sub(r'<[^>]*>', '', text))
+        with self.stage_timer.stage('clean_text'):
+            return self.text_processor.clean_text(text, deadline)
+    
+    def _extract_chapter_title_fast(self, html_content):
+        """用正则在章节开头查找标题，用于超大章节"""
+        head = html_content[:64 * 1024]
+        for tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'title']:
+            match = re.search(rf'(?is)<{tag}\b[^>]*>(.*?)</{tag}\s*>', head)
+            if match:
+                title = html.unescape(re.sub(r'<[^>]*>', '', match.group(1))).strip()
+                if title:
+                    return title
+        return "未知章节"
     
-    def _extract_text_from_html(self, html_content):
+    def _extract_text_from_html(self, html_content, deadline=None):
         """从HTML内容中提取纯文本"""
         try:
-            # 使用BeautifulSoup解析HTML
-            soup = BeautifulSoup(html_content, 'html.parser')
-            
-            # 移除script和style标签
-            for script in soup(["script", "style"]):
-                script.decompose()
-            
-            # 获取文本内容
-            text = soup.get_text()
+            with self.stage_timer.stage('parse_html'):
+                # 使用BeautifulSoup解析HTML
+                soup = BeautifulSoup(html_content, 'html.parser')
+                
+                # 移除script和style标签
+                for script in soup(["script", "style"]):
+                    script.decompose()
+                
+                # 获取文本内容
+                text = soup.get_text()
             
             # 清理文本
-            text = self.text_processor.clean_text(text)
+            with self.stage_timer.stage('clean_text'):
+                text = self.text_processor.clean_text(text, deadline)
             
             return text
             
+        except ConversionTimeout:
+            raise
         except Exception as e:
             logger.error(f"HTML文本提取失败: {str(e)}")
             return ""
@@ -216,31 +333,6 @@ class EpubConverter:
             logger.warning(f"提取章节标题失败: {str(e)}")
             return "未知章节"
     
-    def _merge_chapters(self, chapters, metadata):
-        """合并所有章节内容"""
-        try:
-            # 构建完整的文本内容
-            full_text = []
-            
-            # 添加标题页
-            full_text.append(f"标题：{metadata['title']}")
-            full_text.append(f"作者：{metadata['author']}")
-            if metadata['publisher']:
-                full_text.append(f"出版社：{metadata['publisher']}")
-            full_text.append("=" * 50)
-            full_text.append("")
-            
-            # 添加章节内容（不添加章节编号）
-            for chapter in chapters:
-                full_text.append(chapter['content'])
-                full_text.append("")
-            
-            return "\n".join(full_text)
-            
-        except Exception as e:
-            logger.error(f"合并章节失败: {str(e)}")
-            return ""
-    
     def _ensure_utf8(self, text):
         """确保文本为UTF-8编码"""
         try:
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# 文件状态
+STATUS_UPLOADED = 'uploaded'
+STATUS_CONVERTING = 'converting'
+STATUS_CONVERTED = 'converted'
+STATUS_PARTIAL = 'partial'
+STATUS_FAILED = 'failed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id TEXT PRIMARY KEY,
+    original_name TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    sha256 TEXT,
+    epub_path TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    converted_path TEXT,
+    converted_size INTEGER,
+    chapters_count INTEGER,
+    outputs TEXT,
+    profile_id TEXT,
+    converted_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_files_created_at ON files (created_at);
+CREATE INDEX IF NOT EXISTS idx_files_status_created_at ON files (status, created_at);
+CREATE TABLE IF NOT EXISTS chapters (
+    file_id TEXT NOT NULL,
+    chapter_index INTEGER NOT NULL,
+    title TEXT,
+    byte_offset INTEGER NOT NULL,
+    byte_length INTEGER NOT NULL,
+    PRIMARY KEY (file_id, chapter_index)
+);
+"""
+
+
+class FileIndex:
+    """文件元数据索引（SQLite，WAL模式）
+
+    在上传和转换时写入原始文件名、大小、哈希、转换状态和章节偏移，
+    接口通过一次索引查询获取文件信息，不再逐个检查磁盘。
+
+    status 表示最近一次转换的状态；converted_at 及转换结果字段只在转换成功时更新，
+    重新转换进行中或失败时仍可下载上一次成功的结果。
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        """获取当前线程的数据库连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def add_upload(self, file_id, original_name, size, sha256=None, epub_path=None):
+        """登记新上传的文件"""
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO files '
+                '(file_id, original_name, size, sha256, epub_path, status, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (file_id, original_name, size, sha256, epub_path, STATUS_UPLOADED, now, now)
+            )
+
+    def mark_converting(self, file_id):
+        """标记文件开始转换（已有的转换结果保留）"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'UPDATE files SET status = ?, error = NULL, updated_at = ? WHERE file_id = ?',
+                (STATUS_CONVERTING, time.time(), file_id)
+            )
+
+    def mark_failed(self, file_id, error):
+        """标记文件转换失败（上一次成功的转换结果保留）"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'UPDATE files SET status = ?, error = ?, updated_at = ? WHERE file_id = ?',
+                (STATUS_FAILED, error, time.time(), file_id)
+            )
+
+    def record_conversion(self, file_id, result):
+        """
+        记录转换结果
+
+        Args:
+            file_id: 文件ID
+            result: EpubConverter.convert_to_txt 返回的结果
+        """
+        if not result['success']:
+            self.mark_failed(file_id, result['error'])
+            return
+
+        converted_path = result['converted_path']
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'UPDATE files SET status = ?, error = NULL, converted_path = ?, converted_size = ?, '
+                'chapters_count = ?, outputs = ?, profile_id = ?, converted_at = ?, updated_at = ? '
+                'WHERE file_id = ?',
+                (
+                    STATUS_PARTIAL if result['timed_out'] else STATUS_CONVERTED,
+                    converted_path,
+                    os.path.getsize(converted_path),
+                    result['chapters_count'],
+                    json.dumps({fmt: os.path.basename(path) for fmt, path in result['outputs'].items()}),
+                    result.get('profile_id'),
+                    now,
+                    now,
+                    file_id
+                )
+            )
+            conn.execute('DELETE FROM chapters WHERE file_id = ?', (file_id,))
+            conn.executemany(
+                'INSERT INTO chapters (file_id, chapter_index, title, byte_offset, byte_length) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(file_id, index, chapter['title'], chapter['offset'], chapter['length'])
+                 for index, chapter in enumerate(result['chapters'])]
+            )
+
+    def get(self, file_id):
+        """获取单个文件的记录，不存在时返回 None"""
+        row = self._connect().execute(
+            'SELECT * FROM files WHERE file_id = ?', (file_id,)
+        ).fetchone()
+        return self._to_record(row) if row else None
+
+    def get_chapters(self, file_id):
+        """获取文件的章节标题和偏移"""
+        rows = self._connect().execute(
+            'SELECT chapter_index, title, byte_offset, byte_length FROM chapters '
+            'WHERE file_id = ? ORDER BY chapter_index', (file_id,)
+        ).fetchall()
+        return [{
+            'index': row['chapter_index'],
+            'title': row['title'],
+            'offset': row['byte_offset'],
+            'length': row['byte_length']
+        } for row in rows]
+
+    def list_files(self, status=None, limit=50, offset=0):
+        """
+        按上传时间倒序分页列出文件
+
+        Returns:
+            tuple: (当前页记录列表, 总数)
+        """
+        conn = self._connect()
+        if status:
+            total = conn.execute('SELECT COUNT(*) FROM files WHERE status = ?', (status,)).fetchone()[0]
+            rows = conn.execute(
+                'SELECT * FROM files WHERE status = ? ORDER BY created_at DESC LIMIT ? OFFSET ?',
+                (status, limit, offset)
+            ).fetchall()
+        else:
+            total = conn.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            rows = conn.execute(
+                'SELECT * FROM files ORDER BY created_at DESC LIMIT ? OFFSET ?',
+                (limit, offset)
+            ).fetchall()
+        return [self._to_record(row) for row in rows], total
+
+    def import_existing(self, upload_dir, converted_dir):
+        """将索引建立前已存在的上传文件登记到索引中（已登记的跳过）"""
+        try:
+            names = [name for name in os.listdir(upload_dir) if name.endswith('.epub')]
+        except OSError:
+            return 0
+
+        conn = self._connect()
+        known = {row[0] for row in conn.execute('SELECT file_id FROM files')}
+
+        rows = []
+        for name in names:
+            file_id = name[:-len('.epub')]
+            if file_id in known:
+                continue
+            epub_path = os.path.join(upload_dir, name)
+            txt_path = os.path.join(converted_dir, f"{file_id}.txt")
+            converted = os.path.exists(txt_path)
+            mtime = os.path.getmtime(epub_path)
+            rows.append((
+                file_id, name, os.path.getsize(epub_path), epub_path,
+                STATUS_CONVERTED if converted else STATUS_UPLOADED,
+                txt_path if converted else None,
+                os.path.getsize(txt_path) if converted else None,
+                json.dumps({'txt': f"{file_id}.txt"}) if converted else None,
+                os.path.getmtime(txt_path) if converted else None,
+                mtime, mtime
+            ))
+
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR IGNORE INTO files '
+                '(file_id, original_name, size, epub_path, status, converted_path, converted_size, '
+                'outputs, converted_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            imported = conn.total_changes - before
+
+        if imported:
+            logger.info(f"已将 {imported} 个现有文件登记到索引")
+        return imported
+
+    def _to_record(self, row):
+        """将数据库行转换为接口使用的字典"""
+        return {
+            'fileId': row['file_id'],
+            'fileName': row['original_name'],
+            'fileSize': row['size'],
+            'sha256': row['sha256'],
+            'status': row['status'],
+            'error': row['error'],
+            'convertedSize': row['converted_size'],
+            'chaptersCount': row['chapters_count'],
+            'outputs': json.loads(row['outputs']) if row['outputs'] else {},
+            'profileId': row['profile_id'],
+            'convertedAt': row['converted_at'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+            # 以下为服务内部使用的路径
+            'epubPath': row['epub_path'],
+            'convertedPath': row['converted_path']
+        }
+
+
+def public_record(record):
+    """去掉服务内部路径，返回可对外展示的记录"""
+    return {key: value for key, value in record.items() if key not in ('epubPath', 'convertedPath')}
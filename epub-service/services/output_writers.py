@@ -0,0 +1,180 @@
+import os
+import json
+import logging
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# 临时输出文件的前缀和后缀（.<最终文件名>.<随机串>.part）
+PART_PREFIX = '.'
+PART_SUFFIX = '.part'
+
+
+class _OutputWriter:
+    """输出写入基类
+
+    先写入同目录下的临时文件，转换成功后通过 commit() 原子替换为最终文件，
+    失败时 discard() 删除临时文件，已有的转换结果不受影响。
+    """
+
+    binary = False
+
+    def __init__(self, path):
+        self.path = path
+        fd, self._tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or '.',
+            prefix=f"{PART_PREFIX}{os.path.basename(path)}.",
+            suffix=PART_SUFFIX
+        )
+        if self.binary:
+            self._file = os.fdopen(fd, 'wb')
+        else:
+            self._file = os.fdopen(fd, 'w', encoding='utf-8')
+
+    def close(self):
+        self._file.close()
+
+    def commit(self):
+        """用临时文件替换最终文件"""
+        # mkstemp 创建的文件仅所有者可读，与原来直接写入的文件权限保持一致
+        os.chmod(self._tmp_path, 0o644)
+        os.replace(self._tmp_path, self.path)
+
+    def discard(self):
+        """删除临时文件"""
+        try:
+            os.remove(self._tmp_path)
+        except OSError:
+            pass
+
+
+class TxtWriter(_OutputWriter):
+    """纯文本输出：元数据标题页 + 按顺序排列的章节内容"""
+
+    extension = 'txt'
+    mimetype = 'text/plain'
+    # 以二进制写入，便于记录章节在文件中的字节偏移
+    binary = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._offset = 0
+        self.text_length = 0
+
+    def begin(self, metadata):
+        lines = [
+            f"标题：{metadata['title']}",
+            f"作者：{metadata['author']}"
+        ]
+        if metadata['publisher']:
+            lines.append(f"出版社：{metadata['publisher']}")
+        lines.append("=" * 50)
+        self._write("\n".join(lines) + "\n")
+
+    def write_chapter(self, index, chapter):
+        """
+        写入一个章节（不添加章节编号）
+
+        Returns:
+            tuple: 章节内容在文件中的字节偏移和长度
+        """
+        self._write("\n")
+        offset = self._offset
+        length = self._write(chapter['content'])
+        self._write("\n")
+        return offset, length
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self._file.write(data)
+        self._offset += len(data)
+        self.text_length += len(text)
+        return len(data)
+
+
+class JsonlWriter(_OutputWriter):
+    """JSONL输出：每行一个章节，包含标题、内容及其在TXT文件中的偏移"""
+
+    extension = 'jsonl'
+    mimetype = 'application/x-ndjson'
+
+    def begin(self, metadata):
+        pass
+
+    def write_chapter(self, index, chapter, offset, length):
+        record = {
+            'index': index,
+            'title': chapter['title'],
+            'offset': offset,
+            'length': length,
+            'content': chapter['content']
+        }
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class MarkdownWriter(_OutputWriter):
+    """Markdown输出：书名为一级标题，章节为二级标题"""
+
+    extension = 'md'
+    mimetype = 'text/markdown'
+
+    def begin(self, metadata):
+        self._file.write(f"# {metadata['title']}\n\n")
+        self._file.write(f"作者：{metadata['author']}\n\n")
+        if metadata['publisher']:
+            self._file.write(f"出版社：{metadata['publisher']}\n\n")
+
+    def write_chapter(self, index, chapter, offset, length):
+        title = chapter['title']
+        content = chapter['content']
+        # 正文通常以章节标题开头，避免在标题下重复一次
+        if content.startswith(title):
+            content = content[len(title):].lstrip()
+
+        # 标题可能包含换行，合并为一行后再转义，保证是一个完整的二级标题
+        self._file.write(f"## {self._escape(' '.join(title.split()))}\n\n")
+        for line in content.split('\n'):
+            line = line.strip()
+            if not line:
+                continue
+            self._file.write(self._escape(line) + "\n\n")
+
+    @staticmethod
+    def _escape(line):
+        """转义行首的Markdown标题符号"""
+        if line.startswith('#'):
+            return '\\' + line
+        return line
+
+
+# 可选的附加输出格式，TXT始终生成
+EXTRA_WRITERS = {
+    JsonlWriter.extension: JsonlWriter,
+    MarkdownWriter.extension: MarkdownWriter
+}
+
+OUTPUT_MIMETYPES = {
+    TxtWriter.extension: TxtWriter.mimetype,
+    JsonlWriter.extension: JsonlWriter.mimetype,
+    MarkdownWriter.extension: MarkdownWriter.mimetype
+}
+
+
+def remove_stale_parts(output_dir):
+    """删除异常退出时遗留的临时输出文件，在服务启动时调用"""
+    removed = 0
+    for name in os.listdir(output_dir):
+        if name.startswith(PART_PREFIX) and name.endswith(PART_SUFFIX):
+            try:
+                os.remove(os.path.join(output_dir, name))
+                removed += 1
+            except OSError as e:
+                logger.warning(f"删除临时文件 {name} 失败: {str(e)}")
+    if removed:
+        logger.info(f"已清理 {removed} 个遗留的临时输出文件")
+    return removed
+
+
+def output_path(output_dir, file_id, extension):
+    """获取某种输出格式的文件路径"""
+    return os.path.join(output_dir, f"{file_id}.{extension}")
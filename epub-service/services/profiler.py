@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import time
+import uuid
+import random
+import pstats
+import logging
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# 摘要中保留的热点函数和内存分配位置数量
+TOP_ENTRIES = 25
+PROFILE_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+# 可下载的原始数据：cProfile统计（pstats可读）和tracemalloc快照
+PROFILE_ARTIFACTS = {
+    'prof': 'application/octet-stream',
+    'snapshot': 'application/octet-stream'
+}
+
+
+class StageTimer:
+    """按转换阶段累计耗时"""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            entry = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += elapsed
+            entry['calls'] += 1
+
+
+class _NullStageTimer:
+    """未开启分析时使用的空计时器"""
+
+    _null = nullcontext()
+
+    def stage(self, name):
+        return self._null
+
+
+NULL_STAGE_TIMER = _NullStageTimer()
+
+
+class ConversionProfiler:
+    """按需采集单次转换的CPU分析和内存快照
+
+    通过请求参数显式开启，或按 sample_rate 随机采样。tracemalloc 对整个进程生效，
+    因此同一时间只分析一个转换，其余请求照常执行、不产生额外开销。
+    内存快照和峰值同样是进程级的，包含分析期间其他并发转换的内存分配。
+    """
+
+    def __init__(self, profile_dir, sample_rate=0.0, max_profiles=50):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def should_profile(self, requested=False):
+        """判断本次转换是否需要分析"""
+        return requested or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def run(self, file_id, converter, func, *args, **kwargs):
+        """
+        分析执行 func，结果中附带 profile_id
+
+        Args:
+            file_id: 被转换的文件ID
+            converter: EpubConverter 实例，用于记录各阶段耗时
+            func: 转换函数
+
+        Returns:
+            func 的返回值；已有分析在进行时直接执行，结果中标记 profile_skipped
+        """
+        if not self._lock.acquire(blocking=False):
+            logger.info("已有转换正在分析，本次跳过")
+            result = func(*args, **kwargs)
+            if isinstance(result, dict):
+                result['profile_skipped'] = True
+            return result
+
+        profile_id = uuid.uuid4().hex
+        stage_timer = StageTimer()
+        profiler = cProfile.Profile()
+        tracing_already = tracemalloc.is_tracing()
+
+        try:
+            converter.stage_timer = stage_timer
+            if not tracing_already:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            started = time.perf_counter()
+
+            profiler.enable()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                profiler.disable()
+                duration = time.perf_counter() - started
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                if not tracing_already:
+                    tracemalloc.stop()
+                converter.stage_timer = NULL_STAGE_TIMER
+
+            self._save(profile_id, file_id, profiler, snapshot, stage_timer, duration, peak)
+            if isinstance(result, dict):
+                result['profile_id'] = profile_id
+            return result
+        finally:
+            self._lock.release()
+
+    def list_profiles(self):
+        """列出已保存的分析摘要（最新的在前）"""
+        summaries = []
+        for name in os.listdir(self.profile_dir):
+            if name.endswith('.json'):
+                summary = self.get_summary(name[:-len('.json')])
+                if summary:
+                    summaries.append(summary)
+        summaries.sort(key=lambda summary: summary['createdAt'], reverse=True)
+        return summaries
+
+    def get_summary(self, profile_id):
+        """读取分析摘要，不存在时返回 None"""
+        path = self.artifact_path(profile_id, 'json')
+        if not path or not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def artifact_path(self, profile_id, artifact):
+        """获取分析产物路径，profile_id 非法时返回 None"""
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        return os.path.join(self.profile_dir, f"{profile_id}.{artifact}")
+
+    def _save(self, profile_id, file_id, profiler, snapshot, stage_timer, duration, peak):
+        """保存分析产物并清理旧的分析"""
+        try:
+            profiler.dump_stats(self.artifact_path(profile_id, 'prof'))
+            snapshot.dump(self.artifact_path(profile_id, 'snapshot'))
+
+            stats = pstats.Stats(profiler)
+            top_functions = []
+            for func, (_, calls, total_time, cumulative_time, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True
+            )[:TOP_ENTRIES]:
+                filename, line, name = func
+                top_functions.append({
+                    'function': f"{filename}:{line}({name})",
+                    'calls': calls,
+                    'totalSeconds': round(total_time, 6),
+                    'cumulativeSeconds': round(cumulative_time, 6)
+                })
+
+            top_allocations = [{
+                'location': str(stat.traceback),
+                'sizeBytes': stat.size,
+                'count': stat.count
+            } for stat in snapshot.statistics('lineno')[:TOP_ENTRIES]]
+
+            summary = {
+                'profileId': profile_id,
+                'fileId': file_id,
+                'createdAt': datetime.now().isoformat(),
+                'durationSeconds': round(duration, 6),
+                'memoryPeakBytes': peak,
+                # tracemalloc 跟踪整个进程，而不只是本次转换
+                'memoryScope': 'process',
+                'memoryNote': '内存峰值和内存分配统计包含分析期间其他并发转换的内存分配',
+                'stages': {
+                    name: {'seconds': round(entry['seconds'], 6), 'calls': entry['calls']}
+                    for name, entry in stage_timer.stages.items()
+                },
+                'topFunctions': top_functions,
+                'topAllocations': top_allocations
+            }
+            with open(self.artifact_path(profile_id, 'json'), 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+
+            logger.info(f"转换分析已保存: {profile_id}")
+            self._prune()
+
+        except Exception as e:
+            logger.error(f"保存转换分析失败: {str(e)}")
+
+    def _prune(self):
+        """只保留最近的 max_profiles 份分析"""
+        summaries = self.list_profiles()
+        for summary in summaries[self.max_profiles:]:
+            for artifact in ['json'] + list(PROFILE_ARTIFACTS):
+                try:
+                    os.remove(self.artifact_path(summary['profileId'], artifact))
+                except OSError:
+                    pass
@@ -1,8 +1,21 @@
 import re
 import logging
+from .deadline import ConversionTimeout
 
 logger = logging.getLogger(__name__)
 
+# 超长文本分块处理的块大小（字符数）
+CHUNK_SIZE = 64 * 1024
+# 分块断开位置，保证分块清理与整体清理结果一致：
+# 1. 整段空白之后（空白全部留在前一块），且下一字符不是“第”、实体开头“&”、零宽或控制字符，
+#    否则段落规则、标点规则或实体解码会跨越断点；
+# 2. 中文正文中两个汉字之间（排除章节标记用字），适用于没有空白的中文长段落
+CHUNK_BREAK_PATTERN = re.compile(
+    r'\s+(?=[^\s&第\u200B-\u200D\uFEFF\x00-\x1F\x7F])'
+    r'|(?<=[\u4e00-\u9fff])(?<![第一二三四五六七八九十章节回])'
+    r'(?=[\u4e00-\u9fff])(?![第一二三四五六七八九十章节回])'
+)
+
 class TextProcessor:
     """文本处理工具类"""
     
@@ -29,12 +42,13 @@ class TextProcessor:
             '&trade;': '™'
         }
     
-    def clean_text(self, text):
+    def clean_text(self, text, deadline=None):
         """
         清理和格式化文本
         
         Args:
             text: 原始文本
+            deadline: 可选的时间预算（Deadline），超长文本会分块处理并在块之间检查
             
         Returns:
             str: 清理后的文本
@@ -43,27 +57,75 @@ class TextProcessor:
             return ""
         
         try:
-            # 1. 解码HTML实体
-            text = self._decode_html_entities(text)
-            
-            # 2. 移除多余的空白字符
-            text = self._normalize_whitespace(text)
-            
-            # 3. 清理特殊字符
-            text = self._clean_special_chars(text)
-            
-            # 4. 格式化段落
-            text = self._format_paragraphs(text)
-            
-            # 5. 移除空行
-            text = self._remove_empty_lines(text)
+            if deadline is None or len(text) <= CHUNK_SIZE:
+                text = self._clean_chunk(text)
+            else:
+                text = self._clean_in_chunks(text, deadline)
             
             return text.strip()
             
+        except ConversionTimeout:
+            raise
         except Exception as e:
             logger.error(f"文本清理失败: {str(e)}")
             return text
     
+    def _clean_chunk(self, text):
+        """对一段文本执行完整的清理流程"""
+        # 1. 解码HTML实体
+        text = self._decode_html_entities(text)
+        
+        # 2. 移除多余的空白字符
+        text = self._normalize_whitespace(text)
+        
+        # 3. 清理特殊字符
+        text = self._clean_special_chars(text)
+        
+        # 4. 格式化段落
+        text = self._format_paragraphs(text)
+        
+        # 5. 移除空行
+        text = self._remove_empty_lines(text)
+        
+        return text
+    
+    def _fast_clean_chunk(self, text):
+        """降级模式：只做实体解码和空白标准化，跳过标点和段落处理"""
+        text = self._decode_html_entities(text)
+        return self._normalize_whitespace(text)
+    
+    def _clean_in_chunks(self, text, deadline):
+        """分块清理超长文本，预算用完后剩余部分改用降级模式"""
+        parts = []
+        degraded = False
+        
+        for chunk in self._split_chunks(text):
+            # 整本书超时时协作式取消
+            deadline.check()
+            
+            if not degraded and deadline.expired():
+                degraded = True
+                logger.warning("章节处理超时，剩余内容使用快速模式")
+            
+            if degraded:
+                parts.append(self._fast_clean_chunk(chunk))
+            else:
+                parts.append(self._clean_chunk(chunk))
+        
+        return self._remove_empty_lines("".join(parts))
+    
+    def _split_chunks(self, text):
+        """按约 CHUNK_SIZE 切分文本，只在不影响清理结果的位置断开（找不到时硬切）"""
+        start = 0
+        while start < len(text):
+            end = start + CHUNK_SIZE
+            if end < len(text):
+                match = CHUNK_BREAK_PATTERN.search(text, end, end + 4096)
+                if match:
+                    end = match.end()
+            yield text[start:end]
+            start = end
+    
     def _decode_html_entities(self, text):
         """解码HTML实体"""
         for entity, replacement in self.html_entities.items():